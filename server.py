@@ -8,13 +8,16 @@ v4: adds the single "standard" queue (2:00) used by current clients. The
 legacy bullet/blitz/rapid queues stay so old app versions keep matching each
 other — they never cross-match with standard.
 
-Local:   pip install websockets && python server.py
+Local:   pip install -r requirements.txt && python server.py
 Deploy:  Push to GitHub → Render.com auto-deploys from this repo
 """
 
 import asyncio
-import json
+import itertools
+import logging
+import logging.handlers
 import os
+import queue
 import random
 import sys
 import time
@@ -22,14 +25,18 @@ import time
 sys.stdout.reconfigure(line_buffering=True)
 
 try:
+    import orjson
     import websockets
     from websockets.server import serve
 except ImportError:
-    print("Install: pip install websockets")
+    print("Install: pip install websockets orjson")
     exit(1)
 
+log = logging.getLogger("laserchess")
+
 HOST = "0.0.0.0"
 PORT = int(os.environ.get("PORT", 8765))
+SCORE_FLUSH_INTERVAL = 0.05   # s between opponent_score pushes per match
 
 # --- Chess-themed name generator ---
 _ADJ = [
@@ -46,7 +53,8 @@ def _gen_name():
 class Player:
     __slots__ = ("ws","id","player_id","name",
                  "elo_bullet","elo_blitz","elo_rapid","elo_standard",
-                 "match","best_score","queue_mode","queue_time","hat")
+                 "match","opp","best_score","pending_score","queue_mode","queue_time","hat",
+                 "out_queue","writer","close_task")
     def __init__(self, ws, pid, name):
         self.ws         = ws
         self.id         = pid
@@ -57,32 +65,64 @@ class Player:
         self.elo_rapid  = 1000
         self.elo_standard = 1000
         self.match      = None
+        self.opp        = None
         self.best_score = 0
+        self.pending_score = None
         self.queue_mode = None
         self.queue_time = None
         self.hat        = ""
+        self.out_queue  = asyncio.Queue(maxsize=64)
+        self.writer     = None
+        self.close_task = None
 
 class Match:
-    __slots__ = ("p1","p2","seed","ended","mode")
+    __slots__ = ("p1","p2","seed","ended","mode","score_task")
     def __init__(self, p1, p2, seed, mode):
         self.p1   = p1
         self.p2   = p2
         self.seed = seed
         self.ended = False
         self.mode  = mode
+        self.score_task = None
 
 players = {}   # ws -> Player
+names_in_use = {}   # name -> number of connected players using it
 queues  = {"standard": [], "bullet": [], "blitz": [], "rapid": []}
-_next_id = 0
+_id_iter = itertools.count(1)
+
+# --- Name helpers ---
+
+def _claim_name(name):
+    names_in_use[name] = names_in_use.get(name, 0) + 1
+
+def _release_name(name):
+    n = names_in_use.get(name, 0) - 1
+    if n > 0:
+        names_in_use[name] = n
+    else:
+        names_in_use.pop(name, None)
+
+def _rename(player, name):
+    if name == player.name:
+        return
+    _claim_name(name)
+    _release_name(player.name)
+    player.name = name
 
 # --- ELO helpers ---
 
+_MAX_CLIENT_ELO = 10000
+
 def _get_elo(p, mode):
     if mode == "standard": return p.elo_standard
     if mode == "blitz": return p.elo_blitz
     if mode == "rapid": return p.elo_rapid
     return p.elo_bullet
 
+def _client_elo(value):
+    # Client-reported ratings are untrusted; keep them in a sane int range
+    return max(100, min(_MAX_CLIENT_ELO, int(value)))
+
 def _set_elo(p, mode, value):
     value = max(100, value)
     if mode == "standard": p.elo_standard = value
@@ -90,50 +130,109 @@ def _set_elo(p, mode, value):
     elif mode == "rapid": p.elo_rapid = value
     else: p.elo_bullet = value
 
+# Expected score by integer ELO gap (opp - own). Beyond ±2000 the result is
+# within 1e-5 of 0/1, so gaps are clamped to the table.
+_MAX_ELO_GAP = 2000
+_EXPECTED = [1.0 / (1.0 + 10 ** (d / 400.0)) for d in range(-_MAX_ELO_GAP, _MAX_ELO_GAP + 1)]
+
+def _expected_score(elo, opp_elo):
+    d = max(-_MAX_ELO_GAP, min(_MAX_ELO_GAP, opp_elo - elo))
+    return _EXPECTED[d + _MAX_ELO_GAP]
+
 # --- Communication ---
 
-async def _send(ws, data):
+def _encode(data):
+    # orjson emits UTF-8 bytes; decode so clients keep receiving text frames
+    return orjson.dumps(data).decode()
+
+def _send_raw(player, payload):
+    # Hand off to the player's writer task so a slow socket never blocks the caller
+    if player.close_task:
+        return   # already being dropped; discard anything else sent its way
     try:
-        await ws.send(json.dumps(data))
-    except Exception:
-        pass
+        player.out_queue.put_nowait(payload)
+    except asyncio.QueueFull:
+        # Client stopped draining its socket; drop it instead of buffering forever
+        log.warning("  [WARN] %s outbound queue full, closing", player.name)
+        player.close_task = asyncio.create_task(player.ws.close())
+
+def _send(player, data):
+    try:
+        payload = _encode(data)
+    except orjson.JSONEncodeError as e:
+        # e.g. a client-supplied int past 64 bits; drop it rather than kill the caller
+        log.warning("  [WARN] dropped unencodable %s for %s: %s", data.get("type"), player.name, e)
+        return
+    _send_raw(player, payload)
+
+async def _writer(player):
+    ws = player.ws
+    q  = player.out_queue
+    while True:
+        payload = await q.get()
+        try:
+            await ws.send(payload)
+        except websockets.exceptions.ConnectionClosed:
+            return
+        except Exception:
+            pass
+
+# Identical for every client, so serialize once and reuse
+_MSG_PONG = _encode({"type": "pong"})
+_MSG_QUEUE_CANCELLED = _encode({"type": "queue_cancelled"})
+_MSG_QUEUED = {mode: _encode({"type": "queued", "time_mode": mode}) for mode in queues}
 
 # --- Queue handlers ---
 
+def _dequeue(player):
+    # queue_mode says which queue the player sits in, so only that one is searched
+    q = queues.get(player.queue_mode)
+    if q and player in q:
+        q.remove(player)
+
 async def _handle_queue(player, data):
+    # One match at a time; player.opp assumes it
+    if player.match and not player.match.ended:
+        log.info("  [QUEUE] %s ignored queue request while in a match", player.name)
+        return
+
     mode = data.get("time_mode", "bullet")
     if mode not in queues:
         mode = "bullet"
 
     # Update ELOs from client
-    if "elo_bullet" in data: player.elo_bullet = max(100, int(data["elo_bullet"]))
-    if "elo_blitz"  in data: player.elo_blitz  = max(100, int(data["elo_blitz"]))
-    if "elo_rapid"  in data: player.elo_rapid  = max(100, int(data["elo_rapid"]))
-    if "elo_standard" in data: player.elo_standard = max(100, int(data["elo_standard"]))
-    if "name"      in data and data["name"]: player.name      = data["name"]
+    if "elo_bullet" in data: player.elo_bullet = _client_elo(data["elo_bullet"])
+    if "elo_blitz"  in data: player.elo_blitz  = _client_elo(data["elo_blitz"])
+    if "elo_rapid"  in data: player.elo_rapid  = _client_elo(data["elo_rapid"])
+    if "elo_standard" in data: player.elo_standard = _client_elo(data["elo_standard"])
+    if isinstance(data.get("name"), str) and data["name"]: _rename(player, data["name"])
     if "player_id" in data:                  player.player_id = data["player_id"]
     if "hat"       in data:                  player.hat       = data.get("hat", "")
 
     # Remove from any existing queue
-    for q in queues.values():
-        if player in q:
-            q.remove(player)
+    _dequeue(player)
 
     player.queue_mode = mode
     player.queue_time = time.monotonic()
     queues[mode].append(player)
 
-    await _send(player.ws, {"type": "queued", "time_mode": mode})
-    print(f"  [QUEUE] {player.name} queued for {mode} (ELO {_get_elo(player, mode)}) | queue size: {len(queues[mode])}")
+    _send_raw(player, _MSG_QUEUED[mode])
+    log.info("  [QUEUE] %s queued for %s (ELO %d) | queue size: %d",
+             player.name, mode, _get_elo(player, mode), len(queues[mode]))
 
-async def _handle_leave_queue(player):
-    for q in queues.values():
-        if player in q:
-            q.remove(player)
+async def _handle_leave_queue(player, data):
+    _dequeue(player)
     player.queue_mode = None
     player.queue_time = None
-    await _send(player.ws, {"type": "queue_cancelled"})
-    print(f"  [QUEUE] {player.name} left queue")
+    _send_raw(player, _MSG_QUEUE_CANCELLED)
+    log.info("  [QUEUE] %s left queue", player.name)
+
+async def _handle_update_info(player, data):
+    if isinstance(data.get("name"), str) and data["name"]: _rename(player, data["name"])
+    if "elo_bullet" in data: player.elo_bullet = _client_elo(data["elo_bullet"])
+    if "elo_blitz"  in data: player.elo_blitz  = _client_elo(data["elo_blitz"])
+    if "elo_rapid"  in data: player.elo_rapid  = _client_elo(data["elo_rapid"])
+    if "elo_standard" in data: player.elo_standard = _client_elo(data["elo_standard"])
 
 # --- Match handlers ---
 
@@ -142,8 +241,29 @@ async def _handle_score(player, data):
     if not m or m.ended:
         return
     player.best_score = data.get("best_score", 0)
-    opp = m.p2 if player == m.p1 else m.p1
-    await _send(opp.ws, {"type": "opponent_score", "best_score": player.best_score})
+    # Pushed to the opponent by _score_flush_loop
+    player.pending_score = player.best_score
+
+async def _score_flush_loop(m):
+    # Coalesces score_update bursts into at most one opponent_score per tick
+    while True:
+        await asyncio.sleep(SCORE_FLUSH_INTERVAL)
+        if m.ended:
+            return
+        for p, o in ((m.p1, m.p2), (m.p2, m.p1)):
+            if p.match is m and p.pending_score is not None:
+                _send(o, {"type": "opponent_score", "best_score": p.pending_score})
+                p.pending_score = None
+
+async def _handle_ghost(player, data):
+    m = player.match
+    if not m or m.ended:
+        return
+    _send(player.opp, {
+        "type": "opponent_ghost",
+        "x": data.get("x", 0),
+        "y": data.get("y", 0)
+    })
 
 async def _handle_match_end(player, data):
     m = player.match
@@ -154,13 +274,12 @@ async def _handle_match_end(player, data):
     mode = m.mode
 
     K = 32
+    # Expected scores of both sides sum to 1, so only one pow is needed
+    e1 = _expected_score(_get_elo(m.p1, mode), _get_elo(m.p2, mode))
     elo_changes = {}
-    for p, o in [(m.p1, m.p2), (m.p2, m.p1)]:
+    for p, o, expected in [(m.p1, m.p2, e1), (m.p2, m.p1, 1.0 - e1)]:
         result = "win" if p.best_score > o.best_score else ("lose" if p.best_score < o.best_score else "draw")
         actual = 1.0 if result == "win" else (0.0 if result == "lose" else 0.5)
-        p_elo = _get_elo(p, mode)
-        o_elo = _get_elo(o, mode)
-        expected = 1.0 / (1.0 + 10 ** ((o_elo - p_elo) / 400.0))
         elo_change = int(round(K * (actual - expected)))
         elo_changes[p.id] = (result, elo_change, o)
 
@@ -168,7 +287,7 @@ async def _handle_match_end(player, data):
         result, elo_change, opponent = elo_changes[p.id]
         new_elo = max(100, _get_elo(p, mode) + elo_change)
         _set_elo(p, mode, new_elo)
-        await _send(p.ws, {
+        _send(p, {
             "type": "match_result",
             "result": result,
             "my_score": p.best_score,
@@ -180,34 +299,33 @@ async def _handle_match_end(player, data):
             "time_mode": mode
         })
 
-    m.p1.match = None
-    m.p2.match = None
-    print(f"  [END] {m.p1.name}({_get_elo(m.p1,mode)})={m.p1.best_score} vs "
-          f"{m.p2.name}({_get_elo(m.p2,mode)})={m.p2.best_score} [{mode}]")
+    m.p1.match = None; m.p1.opp = None; m.p1.pending_score = None
+    m.p2.match = None; m.p2.opp = None; m.p2.pending_score = None
+    log.info("  [END] %s(%d)=%s vs %s(%d)=%s [%s]",
+             m.p1.name, _get_elo(m.p1, mode), m.p1.best_score,
+             m.p2.name, _get_elo(m.p2, mode), m.p2.best_score, mode)
 
 async def _handle_disconnect(player):
-    # Remove from any queue
-    for q in queues.values():
-        if player in q:
-            q.remove(player)
-
     m = player.match
     if m and not m.ended:
         m.ended = True
         mode = m.mode
-        opp = m.p2 if player == m.p1 else m.p1
+        opp = player.opp
 
         K = 32
-        p_elo = _get_elo(player, mode)
         o_elo = _get_elo(opp, mode)
-        expected = 1.0 / (1.0 + 10 ** ((p_elo - o_elo) / 400.0))
+        expected = _expected_score(o_elo, _get_elo(player, mode))
         elo_change = int(round(K * (1.0 - expected)))
 
         new_elo = max(100, o_elo + elo_change)
         _set_elo(opp, mode, new_elo)
         opp.match = None
+        opp.opp = None
+        opp.pending_score = None
+        player.opp = None
+        player.pending_score = None
 
-        await _send(opp.ws, {
+        _send(opp, {
             "type": "opponent_disconnected",
             "elo_change": elo_change,
             "my_score": opp.best_score,
@@ -217,11 +335,19 @@ async def _handle_disconnect(player):
             "opponent_player_id": player.player_id,
             "time_mode": mode
         })
-        print(f"  [DC] {player.name} left match -> {opp.name} wins (+{elo_change} {mode} ELO)")
+        log.info("  [DC] %s left match -> %s wins (+%d %s ELO)", player.name, opp.name, elo_change, mode)
 
-    if player.ws in players:
-        del players[player.ws]
-    print(f"  [-] {player.name} disconnected ({len(players)} online)")
+def _release_player(player):
+    # Idempotent, so it is safe even if a disconnect path already ran part of it
+    if player.writer:
+        player.writer.cancel()
+    # Runs once per connection, so don't trust queue_mode here; check every queue
+    for q in queues.values():
+        if player in q:
+            q.remove(player)
+    if players.pop(player.ws, None) is not None:
+        _release_name(player.name)
+        log.info("  [-] %s disconnected (%d online)", player.name, len(players))
 
 # --- Auto-Matchmaking ---
 
@@ -266,6 +392,9 @@ async def _try_match_queue(mode: str):
             matched_ids.add(id(best))
             to_match.append((p1, best))
 
+    if not to_match:
+        return
+
     # Remove matched players from queue before starting matches
     queues[mode] = [p for p in queue if id(p) not in matched_ids]
 
@@ -275,11 +404,17 @@ async def _try_match_queue(mode: str):
 async def _start_match(p1, p2, mode):
     seed = random.randint(0, 2**31 - 1)
     m = Match(p1, p2, seed, mode)
-    p1.match = m; p1.queue_mode = None; p1.best_score = 0
-    p2.match = m; p2.queue_mode = None; p2.best_score = 0
+    p1.match = m; p1.opp = p2; p1.best_score = 0; p1.pending_score = None
+    p2.match = m; p2.opp = p1; p2.best_score = 0; p2.pending_score = None
+    for p in (p1, p2):
+        # A player may have re-queued between pairing and this task running;
+        # they're in a match now, so take them back out of that queue
+        _dequeue(p)
+        p.queue_mode = None
+    m.score_task = asyncio.create_task(_score_flush_loop(m))
 
     match_start_time = time.time()
-    await _send(p1.ws, {
+    _send(p1, {
         "type": "match_start",
         "seed": seed,
         "opponent": p2.name,
@@ -289,7 +424,7 @@ async def _start_match(p1, p2, mode):
         "time_mode": mode,
         "server_time": match_start_time
     })
-    await _send(p2.ws, {
+    _send(p2, {
         "type": "match_start",
         "seed": seed,
         "opponent": p1.name,
@@ -299,7 +434,8 @@ async def _start_match(p1, p2, mode):
         "time_mode": mode,
         "server_time": match_start_time
     })
-    print(f"  [MATCH] {p1.name}({_get_elo(p1,mode)}) vs {p2.name}({_get_elo(p2,mode)}) | {mode} seed={seed}")
+    log.info("  [MATCH] %s(%d) vs %s(%d) | %s seed=%d",
+             p1.name, _get_elo(p1, mode), p2.name, _get_elo(p2, mode), mode, seed)
 
 async def _matchmaking_loop():
     while True:
@@ -308,79 +444,92 @@ async def _matchmaking_loop():
             for mode in queues:
                 await _try_match_queue(mode)
         except Exception as e:
-            print(f"[ERROR] matchmaking loop: {e}")
+            log.error("[ERROR] matchmaking loop: %s", e)
+
+# --- Message dispatch ---
+
+async def _handle_ping(player, data):
+    _send_raw(player, _MSG_PONG)
+
+_DISPATCH = {
+    "queue_for_match": _handle_queue,
+    "leave_queue":     _handle_leave_queue,
+    "score_update":    _handle_score,
+    "ghost_pos":       _handle_ghost,
+    "ping":            _handle_ping,
+    "match_end":       _handle_match_end,
+    "update_info":     _handle_update_info,
+}
 
 # --- WebSocket Handler ---
 
 async def handler(ws):
-    global _next_id
-    _next_id += 1
+    pid = next(_id_iter)
     name = _gen_name()
-    names = {p.name for p in players.values()}
-    while name in names:
+    while name in names_in_use:
         name = _gen_name() + str(random.randint(10, 99))
+    _claim_name(name)
 
-    player = Player(ws, _next_id, name)
+    player = Player(ws, pid, name)
     players[ws] = player
-    print(f"  [+] {name} connected ({len(players)} online)")
-    await _send(ws, {"type": "welcome", "id": player.id, "name": name})
-
     try:
+        log.info("  [+] %s connected (%d online)", name, len(players))
+        player.writer = asyncio.create_task(_writer(player))
+        _send(player, {"type": "welcome", "id": player.id, "name": name})
+
         while True:
             try:
                 raw = await ws.recv()
             except websockets.exceptions.ConnectionClosed:
                 break
             try:
-                data = json.loads(raw)
+                data = orjson.loads(raw)
                 t = data.get("type", "")
 
-                if t == "queue_for_match":
-                    await _handle_queue(player, data)
-
-                elif t == "leave_queue":
-                    await _handle_leave_queue(player)
-
-                elif t == "score_update":
-                    await _handle_score(player, data)
-
-                elif t == "ghost_pos":
-                    m = player.match
-                    if m and not m.ended:
-                        opp = m.p2 if player == m.p1 else m.p1
-                        await _send(opp.ws, {
-                            "type": "opponent_ghost",
-                            "x": data.get("x", 0),
-                            "y": data.get("y", 0)
-                        })
-
-                elif t == "ping":
-                    await _send(player.ws, {"type": "pong"})
+                fn = _DISPATCH.get(t)
+                if fn:
+                    await fn(player, data)
 
-                elif t == "match_end":
-                    await _handle_match_end(player, data)
-
-                elif t == "update_info":
-                    if "name"      in data and data["name"]: player.name      = data["name"]
-                    if "elo_bullet" in data: player.elo_bullet = max(100, int(data["elo_bullet"]))
-                    if "elo_blitz"  in data: player.elo_blitz  = max(100, int(data["elo_blitz"]))
-                    if "elo_rapid"  in data: player.elo_rapid  = max(100, int(data["elo_rapid"]))
-                    if "elo_standard" in data: player.elo_standard = max(100, int(data["elo_standard"]))
-
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 pass
     finally:
-        await _handle_disconnect(player)
+        try:
+            await _handle_disconnect(player)
+        finally:
+            # Runs even if forfeiting the match raised, so no state is left behind
+            _release_player(player)
 
 # --- Main ---
 
+def _start_logging():
+    # Handlers only enqueue records; the listener thread does the stdout writes
+    # so logging never blocks the event loop
+    q = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(q, stream)
+    log.addHandler(logging.handlers.QueueHandler(q))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    listener.start()
+    return listener
+
 async def main():
-    print(f"=== Laser Chess Server v4 (auto-matchmaking, standard queue) ===")
-    print(f"Listening on ws://{HOST}:{PORT}")
-    print()
-    asyncio.create_task(_matchmaking_loop())
-    async with serve(handler, HOST, PORT):
-        await asyncio.Future()
+    listener = _start_logging()
+    try:
+        log.info("=== Laser Chess Server v4 (auto-matchmaking, standard queue) ===")
+        log.info("Listening on ws://%s:%d", HOST, PORT)
+        asyncio.create_task(_matchmaking_loop())
+        # Every message is a few hundred bytes at most; deflate costs more than it saves
+        async with serve(handler, HOST, PORT, compression=None):
+            await asyncio.Future()
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop   # optional, not available on Windows
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())